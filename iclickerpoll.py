@@ -1,42 +1,50 @@
-#!/usr/bin/python
-from __future__ import print_function
+#!/usr/bin/env python3
 
-from usb import USBError
-import usb.core, usb.util
-from array import array
-from collections import defaultdict, Counter
+import usb1
+from collections import Counter
 import logging, time, sys
-import threading
+import threading, queue
 
 log = logging.getLogger(__name__)
 
+# Alpha responses start with 0x81 for A and work their way up, so this maps
+# each response byte to its letter. Bytes outside A-Z map to '?'
+_ALPHA_LUT = tuple(chr(i - 0x81 + 65) if 0x81 <= i < 0x81 + 26 else '?' for i in range(256))
+
 
 class Command(object):
+    """ A 64 byte packet sent to or received from the base. Commands are
+    immutable so that the module-level constants below can be shared. """
+    __slots__ = ('bytes', '_repr', '_info')
+
     def __init__(self, byte_array=None):
         if byte_array is None:
             byte_array = []
 
         if type(byte_array) is str:
             # If we passed in a string, assume it is a string of hex characters and turn it into bytes
-            byte_array = byte_array.replace(' ', '')
-            byte_array = array('B', (int(byte_array[i:i+2], 16) for i in range(0, len(byte_array), 2)))
-        elif type(byte_array) is bytes:
-            pass
+            byte_array = bytes.fromhex(byte_array.replace(' ', ''))
         # Make sure we have a 64 byte packet by padding with zeros
-        self.bytes = array('B', byte_array[:64])
-        self.bytes.extend([0]*(64-len(self.bytes)))
+        object.__setattr__(self, 'bytes', bytes(byte_array[:64]).ljust(64, b'\x00'))
+        # Since commands are immutable, __repr__ and info() are computed at most once
+        object.__setattr__(self, '_repr', None)
+        object.__setattr__(self, '_info', None)
 
     def __getitem__(self, key):
         return self.bytes[key]
 
     def __setitem__(self, key, value):
-        self.bytes[key] = valuse
+        raise TypeError('Command objects are immutable')
+
+    def __setattr__(self, name, value):
+        raise TypeError('Command objects are immutable')
 
     def __repr__(self):
         """ return the command as a hex string """
-        SPLIT_BY_N_CHARS = 16
-        hex_string = ''.join("%02X" % x for x in self.bytes)
-        return ' '.join(hex_string[i:i+SPLIT_BY_N_CHARS] for i in range(0, len(hex_string), SPLIT_BY_N_CHARS)).lower()
+        if self._repr is None:
+            # hex() can put a space between every 8 bytes (16 characters) for us
+            object.__setattr__(self, '_repr', self.bytes.hex(' ', 8))
+        return self._repr
 
     def __eq__(self, other):
         return self.bytes == other.bytes
@@ -45,135 +53,385 @@ class Command(object):
         return self.bytes != other.bytes
 
     def as_bytes(self):
-        return self.bytes.tostring()
+        return self.bytes
 
     @staticmethod
-    def clicker_id_from_bytes(byte_seq):
-        """ Given a sequence of three bytes, computes the last byte
-        in the clicker id and returns it as hex """
-        # Make a copy since we'll be appending to it
-        byte_seq = byte_seq[:]
-        byte_seq.append(byte_seq[0] ^ byte_seq[1] ^ byte_seq[2])
+    def clicker_id_from_bytes(byte_seq, offset=0):
+        """ Given a sequence of three bytes (starting at @offset of @byte_seq),
+        computes the last byte in the clicker id and returns it as hex """
+        b0, b1, b2 = byte_seq[offset], byte_seq[offset+1], byte_seq[offset+2]
+        return bytes((b0, b1, b2, b0 ^ b1 ^ b2)).hex().upper()
 
-        return ''.join("%02X" % b for b in byte_seq)
+    @staticmethod
+    def _make_alpha_info(b, off):
+        """ Returns information about the alpha clicker response that
+        starts at offset @off of the bytes @b """
+        ret = {'type': 'ClickerResponse', 'poll_type': 'Alpha'}
+        ret['clicker_id'] = Command.clicker_id_from_bytes(b, off+3)
+        ret['response'] = _ALPHA_LUT[b[off+2]]
+        ret['seq_num'] = b[off+6]
+
+        return ret
 
     def _process_alpha_clicker_response(self):
         """ This method will return information about an alpha clicker response """
-        ret = {'type': 'ClickerResponse', 'poll_type': 'Alpha'}
-        ret['clicker_id'] = self.clicker_id_from_bytes(self.bytes[3:6])
-        # Responses start with 0x81 for A and work their way up, so ascii-recode them
-        ret['response'] = chr(self.bytes[2] - 0x81 + 65)
-        ret['seq_num'] = self.bytes[6]
-        
-        return ret
+        return self._make_alpha_info(self.bytes, 0)
 
     def info(self):
         """ return all the information we know about the command """
-        byte0 = self.bytes[0]
-        byte1 = self.bytes[1]
+        if self._info is None:
+            object.__setattr__(self, '_info', self._compute_info())
+        return self._info
+
+    def _info_set_frequency(self):
+        return {'type': 'SetFrequency', 'freq1': self.bytes[2] - 0x21, 'freq2': self.bytes[3] - 0x41}
+
+    def _info_start_polling(self):
+        return {'type': 'StartPolling'}
+
+    def _info_stop_polling(self):
+        return {'type': 'StopPolling'}
+
+    def _info_reset_base(self):
+        if self.bytes[2] == 0x01 and self.bytes[3] == 0x00:
+            return {'type': 'ResetBase'}
+        return {}
+
+    def _info_set_poll_type(self):
+        return {'type': 'SetPollType', 'quiz_type': self.bytes[2] - 0x67}
+
+    def _info_set_iclicker2_protocol(self):
+        return {'type': 'SetIClicker2Protocol'}
+
+    # Maps the first two bytes of a command to the method that decodes it
+    _INFO_DISPATCH = {
+        (0x01, 0x10): _info_set_frequency,
+        (0x01, 0x11): _info_start_polling,
+        (0x01, 0x12): _info_stop_polling,
+        (0x01, 0x18): _info_reset_base,
+        (0x01, 0x19): _info_set_poll_type,
+        (0x01, 0x2d): _info_set_iclicker2_protocol,
+        (0x02, 0x13): _process_alpha_clicker_response,
+        }
+
+    def _compute_info(self):
         ret = { 'type': 'unknown', 'raw_command': self.__repr__() }
-        if byte0 == 0x01:
-            if byte1 == 0x10:
-                ret['type'] = 'SetFrequency'
-                ret['freq1'] = self.bytes[2] - 0x21
-                ret['freq2'] = self.bytes[3] - 0x41
-            if byte1 == 0x11:
-                ret['type'] = 'StartPolling'
-            if byte1 == 0x12:
-                ret['type'] = 'StopPolling'
-            if byte1 == 0x18:
-                if self.bytes[2] == 0x01 and self.bytes[3] == 0x00:
-                    ret['type'] = 'ResetBase'
-            if byte1 == 0x19:
-                ret['type'] = 'SetPollType'
-                ret['quiz_type'] = self.bytes[2] - 0x67
-            if byte1 == 0x2d:
-                ret['type'] = 'SetIClicker2Protocol'
-        elif byte0 == 0x02:
-            if byte1 == 0x13:
-                ret.update(self._process_alpha_clicker_response())
-            if byte1 == 0x1a:
-                pass
+        handler = self._INFO_DISPATCH.get((self.bytes[0], self.bytes[1]))
+        if handler is not None:
+            ret.update(handler(self))
 
         return ret
 
     def response_info(self):
         """ Returns a list containing every response in this command.
         Since a 64 byte command can contain two 32 byte clicker responses,
-        this separates them and returns a list with both their infos """
-        info1 = Command(self.bytes[:32]).info()
-        info2 = Command(self.bytes[32:]).info()
+        this separates them and returns a list with both their infos.
+        Unlike info(), these don't include a 'raw_command' """
+        b = self.bytes
         ret = []
-        if info1['type'] == 'ClickerResponse':
-            ret.append(info1)
-        if info2['type'] == 'ClickerResponse':
-            ret.append(info2)
+        for off in (0, 32):
+            if b[off] == 0x02 and b[off+1] == 0x13:
+                ret.append(self._make_alpha_info(b, off))
 
         return ret
-        
+
+
+_CMD_START_POLL = Command("01 11")
+_CMD_STOP_POLL = Command("01 12")
+_CMD_SYNC16 = Command("01 16")
+_CMD_SET_VERSION_TWO_PROTOCOL = Command("01 2d")
+
+#TODO: There are still a lot of unknowns here...right now
+# these just repeat what was snooped from USB on Windows
+_INITIALIZE_SEQUENCE_A = (
+    Command("01 2a 21 41 05"),
+    _CMD_STOP_POLL,
+    Command("01 15"),
+    _CMD_SYNC16,
+    )
+
+_INITIALIZE_SEQUENCE_B = (
+    Command("01 29 a1 8f 96 8d 99 97 8f"),
+    Command("01 17 04"),
+    Command("01 17 03"),
+    _CMD_SYNC16,
+    )
+
+_START_POLL_SEQUENCE = (
+    Command("01 17 03"),
+    Command("01 17 05"),
+    )
+
+_STOP_POLL_SEQUENCE = (
+    _CMD_STOP_POLL,
+    _CMD_SYNC16,
+    Command("01 17 01"),
+    Command("01 17 03"),
+    Command("01 17 04"),
+    )
+
 
 class IClickerBase(object):
     """ This class handles all the hardware-related aspects of talking
     with the iClicker base unit. """
     VENDOR_ID = 0x1881
     PRODUCT_ID = 0x0150
+    READ_ENDPOINT = 0x83
+    # Number of read transfers we keep queued with libusb so that there is
+    # always one waiting when the base sends its next packet
+    NUM_READ_TRANSFERS = 8
+    # How long (in milliseconds) the base gets to accept each control transfer
+    CONTROL_TIMEOUT = 1000
+    # The screen gets messed up if it is written more often than this (in seconds)
+    MIN_SCREEN_UPDATE_TIME = 0.1
     def __init__(self):
+        self.context = usb1.USBContext().open()
         self.device = None
         self.last_set_screen_time = 0
         self.has_initialized = False
-        # pyusb is not threadsafe, so we need to aquire a lock for all usb operations
+        # control transfers must not be interleaved, so we need to aquire a lock for them
         self.usb_lock = threading.RLock()
+        # Every packet read from the base gets pushed onto this queue by _on_read.
+        # stop_poll reads from it inside the SIGINT handler, so it must be reentrant
+        self.queue = queue.SimpleQueue()
+        self.read_transfers = []
+        self.event_thread = None
+        # The event thread runs until close() clears this
+        self.reading = False
+        # Read transfers waiting for _clear_halt to clear a stall on READ_ENDPOINT
+        self._stalled_transfers = []
+        self._stalled_lock = threading.Lock()
         self.screen_buffer = [' '*16, ' '*16]
         self.screen_queue = [False, False] # A list of which line of the screen needs to be updated
+        # Guards screen_buffer/screen_queue and wakes up the _screen_writer thread
+        self.screen_condition = threading.Condition()
+        # The line _screen_writer wrote most recently
+        self._last_screen_line = len(self.screen_buffer) - 1
+        self.screen_thread = threading.Thread(target=self._screen_writer)
+        self.screen_thread.daemon = True
+        self.screen_thread.start()
 
     def _write(self, data):
         """ raw-write of data to self.device"""
         with self.usb_lock:
-            self.device.ctrl_transfer(0x21, 0x09, 0x0200, 0x0000, data.as_bytes())
+            self.device.controlWrite(0x21, 0x09, 0x0200, 0x0000, data.as_bytes(), timeout=self.CONTROL_TIMEOUT)
 
     def _read(self, timeout=100):
-        """ read a packet of data from self.device"""
-        with self.usb_lock:
-            ret = Command(self.device.read(0x83, 64, timeout=timeout))
-        return ret
+        """ read a packet of data from self.device. Raises queue.Empty
+        if no packet arrives within @timeout milliseconds """
+        return self.queue.get(timeout=timeout/1000.)
+
+    def _on_read(self, transfer):
+        """ callback run by libusb whenever one of our read transfers completes """
+        status = transfer.getStatus()
+        if status == usb1.TRANSFER_COMPLETED:
+            self.queue.put(Command(bytes(transfer.getBuffer()[:transfer.getActualLength()])))
+        elif status == usb1.TRANSFER_CANCELLED:
+            # close() cancelled the transfer, so don't resubmit it
+            return
+        elif status == usb1.TRANSFER_NO_DEVICE:
+            log.warning('The iClicker base went away; no longer reading from it')
+            return
+        elif status == usb1.TRANSFER_STALL:
+            # A stalled endpoint keeps stalling until its halt is cleared, which
+            # takes a syncronous control transfer that libusb doesn't allow from
+            # inside a callback, so hand the transfer over to _clear_halt
+            with self._stalled_lock:
+                self._stalled_transfers.append(transfer)
+                if len(self._stalled_transfers) > 1:
+                    # A _clear_halt thread is already running and will resubmit it
+                    return
+            clear_thread = threading.Thread(target=self._clear_halt)
+            clear_thread.daemon = True
+            clear_thread.start()
+            return
+        elif status != usb1.TRANSFER_TIMED_OUT:
+            # Errors, stalls and overflows are usually transient, so keep reading
+            log.warning('Read transfer finished with status {0}; resubmitting it'.format(status))
+        try:
+            transfer.submit()
+        except usb1.USBError as e:
+            log.warning('Could not resubmit read transfer: {0}'.format(e))
+
+    def _clear_halt(self):
+        """ clears the halt on READ_ENDPOINT and resubmits the read transfers
+        that stalled on it """
+        log.warning('The read endpoint stalled; clearing the halt')
+        try:
+            self.device.clearHalt(self.READ_ENDPOINT)
+        except usb1.USBError as e:
+            log.warning('Could not clear the halt on the read endpoint: {0}'.format(e))
+        with self._stalled_lock:
+            stalled, self._stalled_transfers = self._stalled_transfers, []
+        for transfer in stalled:
+            if not self.reading:
+                break
+            try:
+                transfer.submit()
+            except (usb1.USBError, usb1.DoomedTransferError) as e:
+                # DoomedTransferError means close() got to the transfer first
+                log.warning('Could not resubmit read transfer: {0}'.format(e))
+
+    def _start_reading(self):
+        """ submits all our read transfers and starts a thread to handle libusb events """
+        for i in range(self.NUM_READ_TRANSFERS):
+            transfer = self.device.getTransfer()
+            transfer.setInterrupt(self.READ_ENDPOINT, 64, callback=self._on_read)
+            transfer.submit()
+            self.read_transfers.append(transfer)
+        self.reading = True
+
+        def handle_events():
+            # handleEvents sleeps in libusb's own poll() on its file descriptors,
+            # so this only wakes up when there is something to handle
+            while self.reading:
+                self.context.handleEvents()
+
+        self.event_thread = threading.Thread(target=handle_events)
+        self.event_thread.daemon = True
+        self.event_thread.start()
 
     def _syncronous_write(self, data, timeout=100):
         """ writes data to self.device expecting a reponse of "?? ?? aa"
         where "?? ??" are the first two bytes of data """
         expected_response = Command([data[0], data[1], 0xaa])
-        self._write(data)
+        self._submit_batch([data])
         response = self._read(timeout=timeout)
         if response != expected_response:
             raise IOError("Attempted syncronuous write of {0} and got {1} (expecting {2})".format(data.__repr__(), response.__repr__(), expected_response.__repr__()))
+
+    def _handle_events_until(self, is_done, deadline):
+        """ Handles libusb events on this thread until is_done() returns True or
+        time.monotonic() passes @deadline. libusb lets several threads do this at
+        once, so it works whether or not the event thread is still running.
+        Returns whether is_done() became True """
+        while not is_done():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.context.handleEventsTimeout(min(remaining, 0.1))
+        return True
+
+    def _cancel_and_close(self, transfers):
+        """ Cancels any of @transfers that are still submitted, waits (briefly)
+        for libusb to reap them, and closes them """
+        for transfer in transfers:
+            if transfer.isSubmitted():
+                try:
+                    transfer.cancel()
+                except usb1.USBError:
+                    pass
+        self._handle_events_until(lambda: not any(t.isSubmitted() for t in transfers),
+                                  time.monotonic() + 1)
+        for transfer in transfers:
+            if transfer.isSubmitted():
+                log.warning('Control transfer could not be cancelled; leaking it')
+            else:
+                transfer.close()
+
+    def _submit_batch(self, commands, timeout=None):
+        """ Submits a control transfer for every command in @commands back-to-back
+        and blocks until libusb has completed all of them. Each command gets
+        @timeout milliseconds (CONTROL_TIMEOUT by default) of its own """
+        if timeout is None:
+            timeout = self.CONTROL_TIMEOUT
+        completed = []
+        failed = []
+
+        def on_complete(transfer):
+            if transfer.getStatus() != usb1.TRANSFER_COMPLETED:
+                failed.append(transfer.getUserData())
+            completed.append(transfer)
+
+        transfers = []
+        for i, cmd in enumerate(commands):
+            transfer = self.device.getTransfer()
+            # The base handles control transfers one at a time, but libusb starts
+            # every timeout at submission, so each command's timeout also has to
+            # cover the commands queued ahead of it
+            transfer.setControl(0x21, 0x09, 0x0200, 0x0000, cmd.as_bytes(),
+                                callback=on_complete, user_data=cmd, timeout=timeout*(i+1))
+            transfers.append(transfer)
+
+        with self.usb_lock:
+            submitted = []
+            try:
+                for transfer in transfers:
+                    transfer.submit()
+                    submitted.append(transfer)
+                # libusb will have timed out every transfer well before this
+                deadline = time.monotonic() + (len(commands) + 1)*timeout/1000.
+                if not self._handle_events_until(lambda: len(completed) == len(submitted), deadline):
+                    raise IOError("Timed out writing {0}".format(', '.join(c.__repr__() for c in commands)))
+            finally:
+                self._cancel_and_close(transfers)
+
+        if failed:
+            raise IOError("Attempted write of {0} but the transfer failed".format(', '.join(c.__repr__() for c in failed)))
+
     def _write_command_sequence(self, seq):
         """ Write a sequence of commands to the usb device and read all the responses """
-        for cmd in seq:
-            self._write(cmd)
-            try:
-                while True:
-                    response = self._read()
-            except USBError:
-                pass
+        self._submit_batch(seq)
+        try:
+            while True:
+                response = self._read()
+        except queue.Empty:
+            pass
 
     def read(self, timeout=100):
         try:
-            return Command(self._read(timeout))
-        except:
+            return self._read(timeout)
+        except queue.Empty:
             return None
+
+    def read_pending(self):
+        """ returns a list of every packet that has already been read from
+        self.device, without waiting for more """
+        ret = []
+        try:
+            while True:
+                ret.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return ret
         
     def get_base(self):
         """ Looks on the USB bus for an iClicker device """
         with self.usb_lock:
-            self.device = usb.core.find(idVendor=self.VENDOR_ID, idProduct=self.PRODUCT_ID)
+            self.device = self.context.openByVendorIDAndProductID(self.VENDOR_ID, self.PRODUCT_ID)
 
             if self.device is None:
                 raise ValueError('Error: no iclicker device found')
             
-            if self.device.is_kernel_driver_active(0):
+            if self.device.kernelDriverActive(0):
                 log.warning("The iClicker seems to be in use by another device--Forcing reattach.")
-                self.device.detach_kernel_driver(0)
+                self.device.detachKernelDriver(0)
         
-            self.device.set_configuration()
+            self.device.setConfiguration(1)
+            self.device.claimInterface(0)
+        self._start_reading()
+        # Let the screen writer send anything that was set before we had a device
+        with self.screen_condition:
+            self.screen_condition.notify()
+
+    def close(self):
+        """ Stops reading from the base and releases the device and the libusb
+        context. libusb can hang the interpreter on exit if this isn't done """
+        if self.device is not None:
+            # Cancelling the read transfers wakes the event thread up to notice this
+            self.reading = False
+            self._cancel_and_close(self.read_transfers)
+            self.read_transfers = []
+            if self.event_thread is not None:
+                self.event_thread.join(1)
+            with self.usb_lock:
+                try:
+                    self.device.releaseInterface(0)
+                except usb1.USBError as e:
+                    log.warning('Could not release the iClicker interface: {0}'.format(e))
+                self.device.close()
+                self.device = None
+        self.context.close()
 
     def set_base_frequency(self, code1='a', code2='a'):
         """ Sets the operating frequency """
@@ -187,14 +445,12 @@ class IClickerBase(object):
         cmd = Command([0x01, 0x10, 0x21 + code_to_number(code1), 0x41 + code_to_number(code2)])
         self._syncronous_write(cmd)
         time.sleep(0.2)
-        cmd = Command([0x01, 0x16])
-        self._syncronous_write(cmd)
+        self._syncronous_write(_CMD_SYNC16)
         time.sleep(0.2)
 
     def set_version_two_protocol(self):
         """ Sets the base unit to use the iClicker version 2 protocol """
-        cmd = Command([0x01, 0x2d])
-        self._write(cmd)
+        self._write(_CMD_SET_VERSION_TWO_PROTOCOL)
         time.sleep(0.2)
 
     def set_poll_type(self, poll_type='alpha'):
@@ -206,68 +462,34 @@ class IClickerBase(object):
         self._write(cmd)
         time.sleep(0.2)
 
-    #TODO: There are still a lot of unknowns here...right now
-    # it just repeates what was snooped from USB on Windows
     def initialize(self, freq1='a', freq2='a'):
-        COMMAND_SEQUENCE_A = [
-            Command("01 2a 21 41 05"),
-            Command("01 12"),
-            Command("01 15"),
-            Command("01 16"),
-            ]
-        
-        COMMAND_SEQUENCE_B = [
-            Command("01 29 a1 8f 96 8d 99 97 8f"),
-            Command("01 17 04"),
-            Command("01 17 03"),
-            Command("01 16"),
-            ]
-
         if self.device is None:
             self.get_base()
 
         self.set_base_frequency(freq1, freq2)
-        self._write_command_sequence(COMMAND_SEQUENCE_A)
+        self._write_command_sequence(_INITIALIZE_SEQUENCE_A)
         self.set_version_two_protocol()
-        self._write_command_sequence(COMMAND_SEQUENCE_B)
+        self._write_command_sequence(_INITIALIZE_SEQUENCE_B)
         self.has_initialized = True
 
     def start_poll(self, poll_type='alpha'):
-        COMMAND_SEQUENCE_A = [
-            Command("01 17 03"),
-            Command("01 17 05"),
-            ]
-        command_START_POLL = Command("01 11")
-        
-        self._write_command_sequence(COMMAND_SEQUENCE_A)
+        self._write_command_sequence(_START_POLL_SEQUENCE)
         self.set_poll_type(poll_type)
-        self._write(command_START_POLL)
+        self._write(_CMD_START_POLL)
     
     def stop_poll(self):
-        COMMAND_SEQUENCE_A = [
-            Command("01 12"),
-            Command("01 16"),
-            Command("01 17 01"),
-            Command("01 17 03"),
-            Command("01 17 04"),
-            ]
-        
-        self._write_command_sequence(COMMAND_SEQUENCE_A)
+        self._write_command_sequence(_STOP_POLL_SEQUENCE)
     
     def _set_screen(self, line=0):
         """ Sets the line @line to the characters specified by self.screen_buffer[line].
         This command messes up the screen if it is sent too frequently. """
         if line == 0:
-            cmd = [0x01, 0x13]
+            cmd = b'\x01\x13'
         else:
-            cmd = [0x01, 0x14]
-
-        # Make sure we are writing only 16 characters to the screen
-        string = self.screen_buffer[line]
-        string = string[:16]
-        string = string + ' '*(16-len(string))
-        cmd.extend(ord(c) for c in string)
-        cmd = Command(cmd)
+            cmd = b'\x01\x14'
+
+        # set_screen has already padded the buffer to exactly 16 characters
+        cmd = Command(cmd + self.screen_buffer[line].encode('ascii', errors='replace'))
         
         self.last_set_screen_time = time.time()
         
@@ -276,39 +498,55 @@ class IClickerBase(object):
     def set_screen(self, string, line=0, force_update=False):
         """ Sets the line @line to the characters specified by @string.
         This command messes up the screen if it is sent too frequently,
-        so an automatic delay is added between issuances of set_screen """
-        MIN_SCREEN_UPDATE_TIME = 0.1
-        
-        # Set our buffer to the appropriate string, and if our buffer hasn't
-        # changed, just exit--we don't even need to update the screen
-        if string == self.screen_buffer[line] and force_update is False:
-            return
-
-        self.screen_buffer[line] = string
-        self.screen_queue[line] = True
-        
-        def process_screen_queue(line):
-            # if the screenqueue is false, it means another thread already handled updating
-            # the screen for us
-            if self.screen_queue[line] is False:
-                return
-            # Make sure we don't send two write commands too frequently.
-            # If we have tried to send a command too recently, start a 
-            curr_time = time.time()
-            if curr_time - self.last_set_screen_time < MIN_SCREEN_UPDATE_TIME:
-                delay_duration = (MIN_SCREEN_UPDATE_TIME - (curr_time - self.last_set_screen_time))
-                timer = threading.Timer(delay_duration, process_screen_queue, [line])
-                timer.start()
+        so the actual write is left to the _screen_writer thread, which
+        adds a delay between issuances of _set_screen """
+        # Make sure we are writing exactly 16 characters to the screen
+        string = string[:16].ljust(16)
+        with self.screen_condition:
+            # Set our buffer to the appropriate string, and if our buffer hasn't
+            # changed, just exit--we don't even need to update the screen
+            if string == self.screen_buffer[line] and force_update is False:
                 return
 
-            # If the last write wasn't too recent, let's do it!
-            self.screen_queue[line] = False
-            self._set_screen(line)
-        
-        process_screen_queue(line)
+            self.screen_buffer[line] = string
+            self.screen_queue[line] = True
+            self.screen_condition.notify()
+
+    def _screen_writer(self):
+        """ Runs forever on its own thread, writing every line in self.screen_queue
+        to the base as soon as MIN_SCREEN_UPDATE_TIME has passed since the last write """
+        while True:
+            with self.screen_condition:
+                # Lines set before get_base has found the device wait here until it has
+                while True not in self.screen_queue or self.device is None:
+                    self.screen_condition.wait()
+                # Make sure we don't send two write commands too frequently.
+                delay_duration = self.MIN_SCREEN_UPDATE_TIME - (time.time() - self.last_set_screen_time)
+                if delay_duration > 0:
+                    self.screen_condition.wait(delay_duration)
+                    continue
+                # Start looking from the line after the one written last, so
+                # a line that changes constantly can't starve the other one
+                num_lines = len(self.screen_queue)
+                for i in range(1, num_lines + 1):
+                    line = (self._last_screen_line + i) % num_lines
+                    if self.screen_queue[line]:
+                        break
+                self.screen_queue[line] = False
+                self._last_screen_line = line
+            try:
+                self._set_screen(line)
+            except Exception as e:
+                # Don't let one failed write stop all future screen updates;
+                # queue the line again so it is retried after the usual delay
+                log.warning('Failed to set line {0} of the screen: {1}'.format(line, e))
+                with self.screen_condition:
+                    self.screen_queue[line] = True
 
 class Response(object):
     """ Keeps track of all relavent information about a clicker response """
+    __slots__ = ('click_time', 'clicker_id', 'response', 'seq_num', '_key')
+
     def __init__(self, clicker_id=None, response=None, click_time=None, seq_num=None, command=None):
         if click_time is None:
             self.click_time = time.time()
@@ -320,18 +558,20 @@ class Response(object):
         self.clicker_id = clicker_id
         self.response = response
         self.seq_num = seq_num
+        # Two responses are the same click if all of these agree
+        self._key = (clicker_id, response, seq_num)
 
     def __eq__(self, other):
         if type(other) is Response:
-            return self.clicker_id == other.clicker_id and self.response == other.response and self.seq_num == other.seq_num
+            return self._key == other._key
         else:
             return False
 
     def __ne__(self, other):
-        if type(other) is Response:
-            return self.clicker_id != other.clicker_id or self.response != other.response or self.seq_num != other.seq_num
-        else:
-            return True
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key)
 
     def __repr__(self):
         return "{0}: {1} ({2} at {3})".format(self.clicker_id, self.response, self.seq_num, self.click_time)
@@ -342,17 +582,31 @@ class IClickerPoll(object):
         self.STOP_POLL = False
         self.should_print = True
         self.poll_start_time = 0
-        self.responses = defaultdict(list)
+        # Only the most recent response of each clicker is displayed or saved,
+        # so that is all we keep. Maps clicker id to its latest Response
+        self.latest = {}
+        # The Response._key of every click we have already seen from each clicker,
+        # so that retransmissions of older clicks aren't mistaken for new answers
+        self._seen = {}
+        # How many clickers currently have each response, kept up to date by add_response
+        self.tally = Counter()
+        # update_display only redraws when the tally or the elapsed second has changed
+        self._display_dirty_tally = False
+        self._last_display_sec = -1
 
     def update_display(self):
         """ updates the base display according to the poll results """
-        
+        elapsed_secs = int(time.time() - self.poll_start_time)
+        if not self._display_dirty_tally and elapsed_secs == self._last_display_sec:
+            return
+        self._display_dirty_tally = False
+        self._last_display_sec = elapsed_secs
+
         # Write the distribution of votes to the second line of the display
         out_string = " 0  0  0  0  0 "
-        recent_responses = self.get_most_recent_responses()
-        tally = Counter(r.response for r in recent_responses if r.response != 'F') #'F' means retract answer
-        if len(tally) > 0:
-            total = sum(tally.values())
+        tally = self.tally
+        total = sum(tally.values())
+        if total > 0:
             out_string = "{0} {1} {2} {3} {4}".format(int(100*tally['A']/total),
                                                       int(100*tally['B']/total),
                                                       int(100*tally['C']/total),
@@ -361,12 +615,11 @@ class IClickerPoll(object):
         self.base.set_screen(out_string, line=1)
 
         # Write the time and number of total votes to the first line of the display
-        secs = int(time.time() - self.poll_start_time)
-        mins = secs // 60
-        secs = secs % 60
+        mins = elapsed_secs // 60
+        secs = elapsed_secs % 60
 
         out_string_time = "{0}:{1:02}".format(mins, secs)
-        out_string = "{0}{1:>{padding}}".format(out_string_time, sum(tally.values()), padding=(16-len(out_string_time)))
+        out_string = "{0}{1:>{padding}}".format(out_string_time, total, padding=(16-len(out_string_time)))
         self.base.set_screen(out_string, line=0)
 
     def start_poll(self, poll_type='alpha'):
@@ -394,37 +647,71 @@ class IClickerPoll(object):
         """ Constantly polls the usb device for clicker responses """
 
         self.display_update_loop()
+        # Look these up once rather than on every trip around the loop
+        read = self.base.read
+        read_pending = self.base.read_pending
+        add_response = self.add_response
+        update_display = self.update_display
+        get_info = Command.response_info
         while self.STOP_POLL is False:
-            response = self.base.read(50)
+            # Packets are read asyncronously, so this returns as soon as one
+            # arrives; the timeout only bounds how long until we notice STOP_POLL
+            response = read(1000)
             # if there is no response, do nothing but update the display
             if response is None:
                 continue
-            for info in response.response_info():
-                self.add_response(Response(info['clicker_id'], info['response'],
-                                           time.time(), info['seq_num']))
-            self.update_display()
+            # Handle every packet that queued up while we were busy, then
+            # update the display once for the whole batch
+            click_time = time.time()
+            for response in [response] + read_pending():
+                for info in get_info(response):
+                    add_response(Response(info['clicker_id'], info['response'],
+                                          click_time, info['seq_num']))
+            update_display()
 
     def display_update_loop(self, interval=1):
         """ Spawns a new thread and updates the display every @interval
         number of seconds """
 
         def update():
+            update_display = self.update_display
+            sleep = time.sleep
             while self.STOP_POLL is False:
-                self.update_display()
-                time.sleep(interval)
+                update_display()
+                sleep(interval)
 
         display_thread = threading.Thread(target=update)
         display_thread.start()
 
     def add_response(self, response):
-        """ Adds a response to the response list """
-        if response not in self.responses[response.clicker_id]:
-            self.responses[response.clicker_id].append(response)
-            self.print_response(response)
+        """ Records @response as the latest response of its clicker, unless
+        it is a repeat of a click we have already seen """
+        seen = self._seen.setdefault(response.clicker_id, set())
+        if response._key in seen:
+            return
+        seen.add(response._key)
+
+        previous = self.latest.get(response.clicker_id)
+        self.latest[response.clicker_id] = response
+        self._update_tally(previous, response)
+        self._display_dirty_tally = True
+        self.print_response(response)
+
+    def _update_tally(self, previous_response, response):
+        """ Moves the clicker of @response from the tally of its previous
+        response to the tally of its new one """
+        previous = previous_response.response if previous_response is not None else None
+        if previous == response.response:
+            return
+        #'F' means retract answer, so it isn't counted
+        if previous is not None and previous != 'F':
+            self.tally[previous] -= 1
+        if response.response != 'F':
+            self.tally[response.response] += 1
 
     def get_most_recent_responses(self):
         """ returns a list of the most recent responses """
-        return [self.responses[key][-1] for key in self.responses.keys()]
+        return list(self.latest.values())
 
     def get_most_recent_responses_formatted(self):
         """ returns a csv formatted string containing all the responses for
@@ -508,3 +795,5 @@ if __name__ == '__main__':
         print('Writing results to {0}'.format(file_name))
         with open(file_name, 'w') as out_file:
             out_file.write(poll.get_most_recent_responses_formatted())
+
+    base.close()